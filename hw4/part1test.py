@@ -1,7 +1,7 @@
 import unittest
 
 from kvstore import InMemoryKVStore
-from student import USER, TransactionHandler
+from student import USER, ShardedLockTable, TransactionHandler
 
 class Part1Test(unittest.TestCase):
     def test_commit(self):
@@ -175,5 +175,33 @@ class Part1Test(unittest.TestCase):
         self.assertEqual(t1.check_lock(), 'Success')
         self.assertEqual(t1.perform_get('a'), '1')
 
+    def test_rewrite_keeps_exclusive_lock(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.perform_get('a'), '0')                   # T0 R(a)
+        self.assertEqual(t0.perform_put('a', '1'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.perform_put('a', '2'), 'Success')        # T0 W(a)
+        self.assertEqual(t1.perform_get('a'), None)                  # T1 R(a)
+        self.assertEqual(t0._undo_log, [('a', None)])
+        self.assertEqual(t0.abort(USER), 'User Abort')
+        self.assertEqual(t1.check_lock(), 'No such key')
+
+    def test_sharded_lock_table(self):
+        lock_table = ShardedLockTable(4)
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        self.assertEqual(t0.perform_put('a', '0'), 'Success')        # T0 W(a)
+        self.assertEqual(t0.perform_put('b', '0'), 'Success')        # T0 W(b)
+        self.assertEqual(t1.perform_get('a'), None)                  # T1 R(a)
+        self.assertEqual(len(lock_table), 2)
+        self.assertTrue('a' in lock_table and 'b' in lock_table)
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(t1.check_lock(), '0')
+        self.assertRaises(ValueError, ShardedLockTable, 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,8 @@
 import unittest
 
+import student
 from kvstore import InMemoryKVStore
-from student import DEADLOCK, USER, TransactionCoordinator, TransactionHandler
+from student import DEADLOCK, USER, ShardedLockTable, TransactionCoordinator, TransactionHandler
 
 class Part2Test(unittest.TestCase):
     def test_deadlock_rw_rw(self):
@@ -79,5 +80,86 @@ class Part2Test(unittest.TestCase):
         abort_id = coordinator.detect_deadlocks()
         self.assertTrue(abort_id == 1 or abort_id == 2)
 
+    def test_deadlock_three_way(self):
+        lock_table = {}
+        self.check_deadlock_three_way(lock_table)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(coordinator._waits_for, {1: set([2])})
+
+    def test_deadlock_three_way_sharded(self):
+        lock_table = ShardedLockTable()
+        self.check_deadlock_three_way(lock_table)
+        self.assertEqual(lock_table.waits_for, {1: set([2])})
+
+    def test_abort_after_grant_before_check_lock(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_put('a', 'a1'), None)            # T1 W(a)
+        self.assertEqual(t0.commit(), 'Transaction Completed')       # grants T1
+        self.assertEqual(t1.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(t2.perform_put('a', 'a2'), 'Success')
+
+    def test_detect_skips_search_with_one_waiter(self):
+        lock_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_get('a'), None)                  # T1 R(a)
+        self.assertEqual(len(coordinator._waits_for), 1)
+
+        def fail(graph):
+            self.fail('cycle search ran with a single blocked transaction')
+        search = student._strongly_connected_components
+        student._strongly_connected_components = fail
+        try:
+            self.assertEqual(coordinator.detect_deadlocks(), None)
+        finally:
+            student._strongly_connected_components = search
+        self.assertEqual(t0.commit(), 'Transaction Completed')
+        self.assertEqual(len(coordinator._waits_for), 0)
+        self.assertEqual(t1.check_lock(), 'a0')
+
+    def test_graph_not_shared_on_id_reuse(self):
+        old_table = {}
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(old_table, 0, store)
+        t1 = TransactionHandler(old_table, 1, store)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Success')       # T1 W(b)
+        self.assertEqual(t0.perform_get('b'), None)                  # T0 R(b)
+        self.assertEqual(t1.perform_get('a'), None)                  # T1 R(a)
+        stale_graph = student._waits_for_graph_of(old_table)
+        self.assertTrue(stale_graph.table is old_table)
+        # Simulate a new table being allocated at the old table's address.
+        new_table = {}
+        student._waits_for_graphs[id(new_table)] = stale_graph
+        coordinator = TransactionCoordinator(new_table)
+        self.assertEqual(coordinator._waits_for, {})
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+
+    def check_deadlock_three_way(self, lock_table):
+        store = InMemoryKVStore()
+        t0 = TransactionHandler(lock_table, 0, store)
+        t1 = TransactionHandler(lock_table, 1, store)
+        t2 = TransactionHandler(lock_table, 2, store)
+        coordinator = TransactionCoordinator(lock_table)
+        self.assertEqual(t0.perform_put('a', 'a0'), 'Success')       # T0 W(a)
+        self.assertEqual(t1.perform_put('b', 'b1'), 'Success')       # T1 W(b)
+        self.assertEqual(t2.perform_put('c', 'c2'), 'Success')       # T2 W(c)
+        self.assertEqual(t0.perform_get('b'), None)                  # T0 R(b)
+        self.assertEqual(t1.perform_get('c'), None)                  # T1 R(c)
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t2.perform_get('a'), None)                  # T2 R(a)
+        self.assertEqual(coordinator.detect_deadlocks(), 0)
+        self.assertEqual(t0.abort(DEADLOCK), 'Deadlock Abort')
+        self.assertEqual(coordinator.detect_deadlocks(), None)
+        self.assertEqual(t2.check_lock(), 'No such key')
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,7 @@
 import logging
+import threading
+import weakref
+from collections import OrderedDict, deque
 
 from kvstore import DBMStore, InMemoryKVStore
 
@@ -12,10 +15,12 @@ Possible abort modes.
 USER = 0
 DEADLOCK = 1
 
-class RequestLock:
+class RequestLock(object):
     """
     The item in the Lock's request lock queue.
     """
+    __slots__ = ('transaction', 'mode')
+
     def __init__(self, transaction, mode):
         """
         @param xid: transaction.
@@ -24,17 +29,31 @@ class RequestLock:
         self.transaction = transaction
         self.mode = mode
 
-class Lock:
+class Lock(object):
     """
     The lock infomation about the key in lock table.
     """
-    ExclusiveLock = "ExclusiveLock"
-    SharedLock = "SharedLock"
+    # Locks are created per key and touched on every request; slots keep them
+    # small and make attribute access cheaper than a per-instance __dict__.
+    __slots__ = ('transactions', 'mode', 'request_queue', 'waits_for')
+
+    # Lock modes are unique sentinels and are always compared with `is`.
+    ExclusiveLock = object()
+    SharedLock = object()
     
-    def __init__(self, transaction, mode, request_queue=None):
-        self.transactions = [transaction]
+    def __init__(self, transaction, mode, request_queue=None, waits_for=None):
+        """
+        @param waits_for: optional waits-for graph shared by every lock in the
+        lock table, a dict mapping the xid of each waiting transaction to the
+        set of xids it waits for. Kept up to date as requests are queued and
+        granted.
+        """
+        # Holders of the lock, in the order they were granted it. Only the keys
+        # are used; the mapping gives O(1) membership tests and removal.
+        self.transactions = OrderedDict([(transaction, None)])
         self.mode = mode
         self.request_queue = request_queue
+        self.waits_for = waits_for
         
     def request_lock(self, transaction, mode):
         """
@@ -43,23 +62,19 @@ class Lock:
         """
         if self.can_acquire_lock(transaction, mode):
             if transaction not in self.transactions:
-                self.transactions.append(transaction)
-            self.mode = mode
+                self.transactions[transaction] = None
+                if self.request_queue:
+                    self._update_waits_for()
+            # A shared request from an exclusive holder must not downgrade.
+            if mode is Lock.ExclusiveLock or self.mode is None:
+                self.mode = mode
             return True
         else:
             if transaction in self.transactions:
-                self.transactions.remove(transaction)
+                del self.transactions[transaction]
             self._append_request(transaction, mode)
             return False
     
-    def first_current_transaction(self):
-        if len(self.current_transactions()):
-            return self.current_transactions()[0]
-        return None
-    
-    def current_transactions(self):
-        return self.transactions
-    
     def hold_lock(self, transaction, mode):
         """
         Return True if transaction current hold the lock and match mode.
@@ -86,64 +101,203 @@ class Lock:
         If there is a queue not empty, grant the next transation request.
         """
         if transaction in self.transactions:
-            self.transactions.remove(transaction)
+            del self.transactions[transaction]
             
         if len(self.transactions) == 0:
             self.mode = None
             self._grant_request()
+        if self.request_queue:
+            self._update_waits_for()
     
     def _append_request(self, transaction, mode):
         """
         Append the lock in the request queue.
         If transaction already request the lock before, upgrade it.
         """
-        def has_request_and_update():
-            for r in self.request_queue:
-                if r.transaction is transaction:
-                    if r.mode is Lock.SharedLock:
-                        r.mode = mode
-                        return True
-            return False
-
-        if self.request_queue:
-            if not has_request_and_update():
-                self.request_queue.append(RequestLock(transaction, mode))
+        request_queue = self.request_queue
+        if request_queue:
+            for r in request_queue:
+                if r.transaction is transaction and r.mode is Lock.SharedLock:
+                    r.mode = mode
+                    break
+            else:
+                request_queue.append(RequestLock(transaction, mode))
         else:
-            self.request_queue = [RequestLock(transaction, mode)]
+            self.request_queue = deque([RequestLock(transaction, mode)])
+        self._update_waits_for()
     
+    def cancel_request(self, transaction):
+        """
+        Remove the transaction's pending request from the request queue.
+        """
+        if self.request_queue:
+            self.request_queue = deque(r for r in self.request_queue
+                                       if r.transaction is not transaction)
+        if self.waits_for is not None:
+            self.waits_for.pop(transaction._xid, None)
+
     def _grant_request(self):
         """
         Grant next transaction request in the request queue.
         """
-        if self.request_queue and len(self.request_queue):
-            request = self.request_queue.pop(0)
-            self.transactions.append(request.transaction)
+        if self.request_queue:
+            request = self.request_queue.popleft()
+            self.transactions[request.transaction] = None
             self.mode = request.mode
-            
+            if self.waits_for is not None:
+                self.waits_for.pop(request.transaction._xid, None)
+
+    def _update_waits_for(self):
+        """
+        Point every waiter in the request queue at the current holders.
+        """
+        if self.waits_for is None:
+            return
+        holders = set(t._xid for t in self.transactions)
+        for r in self.request_queue:
+            self.waits_for[r.transaction._xid] = holders
+
+
+class _WaitsForGraph(dict):
+    """
+    A waits-for graph: maps the xid of each waiting transaction to the set of
+    xids it waits for. Subclasses dict so that it can be weakly referenced.
+    """
+
+    def __init__(self, table):
+        """
+        @param table: the lock table the graph belongs to. Holding it keeps
+        the table's id() from being reused while the graph is alive.
+        """
+        dict.__init__(self)
+        self.table = table
+
+
+# Waits-for graphs of lock tables that cannot hold one themselves, such as the
+# plain dict the server uses, keyed by id() of the table. The table's handlers,
+# Locks and coordinator keep the graph alive, and the entry goes with them.
+_waits_for_graphs = weakref.WeakValueDictionary()
+
+
+def _waits_for_graph_of(lock_table):
+    """
+    Return the waits-for graph shared by everything using @lock_table.
+    """
+    graph = getattr(lock_table, 'waits_for', None)
+    if graph is None:
+        graph = _waits_for_graphs.get(id(lock_table))
+        if graph is None or graph.table is not lock_table:
+            graph = _waits_for_graphs[id(lock_table)] = _WaitsForGraph(lock_table)
+    return graph
+
+
+class ShardedLockTable:
+    """
+    A drop-in replacement for the global lock table dict. Keys are spread over
+    NUM_SHARDS independent dicts, each guarded by its own mutex, so operations
+    on unrelated keys never serialize on the same map.
+
+    Only the key -> Lock map is thread-safe. The Lock objects themselves
+    (holders, request queue, mode) and the shared waits_for graph are updated
+    without synchronization. Like the rest of this module, they assume the
+    server's single thread of control.
+    """
+    NUM_SHARDS = 64
+
+    def __init__(self, num_shards=NUM_SHARDS):
+        """
+        @param num_shards: number of shards, must be a power of two.
+        """
+        if num_shards <= 0 or num_shards & (num_shards - 1):
+            raise ValueError('num_shards must be a power of two')
+        self._mask = num_shards - 1
+        self._shards = [{} for _ in range(num_shards)]
+        self._locks = [threading.Lock() for _ in range(num_shards)]
+        self.waits_for = _WaitsForGraph(self)
+
+    def _shard(self, key):
+        return hash(key) & self._mask
+
+    def get(self, key, default=None):
+        i = self._shard(key)
+        with self._locks[i]:
+            return self._shards[i].get(key, default)
+
+    def setdefault(self, key, default=None):
+        i = self._shard(key)
+        with self._locks[i]:
+            return self._shards[i].setdefault(key, default)
+
+    def items(self):
+        """
+        Return a snapshot of all (key, lock) pairs, taking one shard at a time.
+        """
+        result = []
+        for shard, mutex in zip(self._shards, self._locks):
+            with mutex:
+                result.extend(shard.items())
+        return result
+
+    def values(self):
+        return [lock for _, lock in self.items()]
+
+    def __getitem__(self, key):
+        i = self._shard(key)
+        with self._locks[i]:
+            return self._shards[i][key]
+
+    def __setitem__(self, key, value):
+        i = self._shard(key)
+        with self._locks[i]:
+            self._shards[i][key] = value
+
+    def __contains__(self, key):
+        i = self._shard(key)
+        with self._locks[i]:
+            return key in self._shards[i]
+
+    def __len__(self):
+        total = 0
+        for shard, mutex in zip(self._shards, self._locks):
+            with mutex:
+                total += len(shard)
+        return total
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
 
 """
 Part I: Implementing request handling methods for the transaction handler
 
 The transaction handler has access to the following objects:
 
-self._lock_table: the global lock table. More information in the README.
+self._lock_table: the global lock table. More information in the README. This
+is either a plain dict or a ShardedLockTable; only get(), setdefault(), items()
+and item access are used on it.
 
-self._acquired_locks: a list of locks acquired by the transaction. Used to
-release locks when the transaction commits or aborts. This list is initially
+self._acquired_locks: an ordered mapping from each key locked by the
+transaction to its Lock. Used to release locks when the transaction commits or
+aborts without going back through the lock table. This mapping is initially
 empty.
 
-self._desired_lock: the lock that the transaction is waiting to acquire as well
-as the operation to perform. This is initialized to None.
+self._desired_lock: the operation the transaction is waiting to perform, as a
+tuple ('put', @key, @value) or ('get', @key). The key names the lock it is
+waiting to acquire. This is initialized to None.
 
 self._xid: this transaction's ID. You may assume each transaction is assigned a
 unique transaction ID.
 
+self._waits_for: the waits-for graph shared by all users of the lock table. It is
+handed to every Lock the transaction creates.
+
 self._store: the in-memory key-value store. You may refer to kvstore.py for
 methods supported by the store.
 
 self._undo_log: a list of undo operations to be performed when the transaction
 is aborted. The undo operation is a tuple of the form (@key, @value). This list
-is initially empty.
+is initially empty. Only the first write of each key is logged, since abort
+only needs the original value; self._undo_seen holds the keys logged so far.
 
 You may assume that the key/value inputs to these methods are already type-
 checked and are valid.
@@ -153,11 +307,24 @@ class TransactionHandler:
 
     def __init__(self, lock_table, xid, store):
         self._lock_table = lock_table
-        self._acquired_locks = []
+        self._waits_for = _waits_for_graph_of(lock_table)
+        self._acquired_locks = OrderedDict()
         self._desired_lock = None
         self._xid = xid
         self._store = store
         self._undo_log = []
+        self._undo_seen = set()
+
+    def _get_or_create_lock(self, key, mode):
+        """
+        Return the lock for @key, adding a new one held in @mode by this
+        transaction if the lock table has no entry for it yet.
+        """
+        lock = self._lock_table.get(key)
+        if lock is None:
+            lock = self._lock_table.setdefault(
+                key, Lock(self, mode, waits_for=self._waits_for))
+        return lock
 
     def perform_put(self, key, value):
         """
@@ -182,18 +349,22 @@ class TransactionHandler:
         is waiting to acquire in self._desired_lock.
         """
         # Part 1.1: your code here!
-        lock = self._lock_table.get(key)
-        if lock is None:
-            lock = self._lock_table[key] = Lock(self, Lock.ExclusiveLock)
+        lock = self._acquired_locks.get(key)
+        if (lock is not None and key in self._undo_seen and
+                lock.hold_lock(self, Lock.ExclusiveLock)):
+            # Rewrite under a lock we already hold; the undo entry exists.
+            self._store.put(key, value)
+            return 'Success'
+        lock = self._get_or_create_lock(key, Lock.ExclusiveLock)
         if lock.request_lock(self, Lock.ExclusiveLock):
-            old_value = self._store.get(key)
-            self._undo_log.append((key, old_value))
-            self._acquired_locks.append(key)
+            if key not in self._undo_seen:
+                self._undo_log.append((key, self._store.get(key)))
+                self._undo_seen.add(key)
+            self._acquired_locks[key] = lock
             self._store.put(key, value)
             return 'Success'
         else:
-            op = lambda: self.perform_put(key, value)
-            self._desired_lock = (key, Lock.ExclusiveLock, op)
+            self._desired_lock = ('put', key, value)
             return None
 
     def perform_get(self, key):
@@ -215,19 +386,21 @@ class TransactionHandler:
         self._desired_lock.
         """
         # Part 1.1: your code here!
-        lock = self._lock_table.get(key)
-        if lock is None:
-            lock = self._lock_table[key] = Lock(self, Lock.SharedLock)
+        lock = self._acquired_locks.get(key)
+        if lock is not None and self in lock.transactions:
+            # Either lock mode already covers a read.
+            value = self._store.get(key)
+            return 'No such key' if value is None else value
+        lock = self._get_or_create_lock(key, Lock.SharedLock)
         if lock.request_lock(self, Lock.SharedLock):
-            self._acquired_locks.append(key)
+            self._acquired_locks[key] = lock
             value = self._store.get(key)
             if value is None:
                 return 'No such key'
             else:
                 return value
         else:
-            op = lambda: self.perform_get(key)
-            self._desired_lock = (key, Lock.SharedLock, op)
+            self._desired_lock = ('get', key)
             return None
 
     def release_and_grant_locks(self):
@@ -236,17 +409,24 @@ class TransactionHandler:
         next transactions in the queue. This is a helper method that is called
         during transaction commits or aborts. 
 
-        Hint: you can use self._acquired_locks to get a list of locks acquired
+        Hint: you can use self._acquired_locks to get the locks acquired
         by the transaction.
         Hint: be aware that lock upgrade may happen.
 
         @param self: the transaction handler.
         """
-        for l in self._acquired_locks:
+        if self._desired_lock:
+            # The request may still be queued, or may have been granted before
+            # check_lock() picked it up; handle both.
+            lock = self._lock_table.get(self._desired_lock[1])
+            lock.cancel_request(self)
+            lock.release_lock(self)
+            self._desired_lock = None
+        for lock in self._acquired_locks.values():
             # Part 1.2: your code here!
-            lock = self._lock_table.get(l)
             lock.release_lock(self)
-        self._acquired_locks = []
+        self._acquired_locks = OrderedDict()
+        self._undo_seen = set()
 
     def commit(self):
         """
@@ -308,10 +488,10 @@ class TransactionHandler:
 
         Hint: self._desired_lock contains the lock that the transaction is
         waiting to acquire.
-        Hint: remember to update the self._acquired_locks list if the lock has
+        Hint: remember to update self._acquired_locks if the lock has
         been granted.
         Hint: if the transaction has been granted an exclusive lock due to lock
-        upgrade, remember to clean up the self._acquired_locks list.
+        upgrade, remember to clean up self._acquired_locks.
         Hint: remember to update self._undo_log so that we can undo all the
         changes if the transaction later gets aborted.
 
@@ -323,16 +503,19 @@ class TransactionHandler:
         returns None.
         """
         # Part 1.3: your code here!
-        if not self._desired_lock:
+        desired_lock = self._desired_lock
+        if not desired_lock:
             return None
-        
-        key, lock_mode, op = self._desired_lock
+
+        key = desired_lock[1]
         lock = self._lock_table.get(key)
-        if lock.hold_lock(self, lock_mode):
-            v = op()
-            if v:
+        if desired_lock[0] == 'put':
+            if lock.hold_lock(self, Lock.ExclusiveLock):
                 self._desired_lock = None
-            return v
+                return self.perform_put(key, desired_lock[2])
+        elif self in lock.transactions:
+            self._desired_lock = None
+            return self.perform_get(key)
         return None
 
 
@@ -341,15 +524,19 @@ class TransactionHandler:
 """
 Part II: Implement deadlock detection method for the transaction coordinator
 
-The transaction coordinator has access to the following object:
+The transaction coordinator has access to the following objects:
 
 self._lock_table: see description from Part I
+
+self._waits_for: the waits-for graph of the lock table, shared with every Lock
+in it and kept up to date as requests are queued and granted.
 """
 
 class TransactionCoordinator:
 
     def __init__(self, lock_table):
         self._lock_table = lock_table
+        self._waits_for = _waits_for_graph_of(lock_table)
 
     def detect_deadlocks(self):
         """
@@ -377,17 +564,65 @@ class TransactionCoordinator:
         @return: If there are no cycles in the waits-for graph, returns None.
         Otherwise, returns the xid of a transaction in a cycle.
         """
-        def get_desired_key_tranc(lock):
-            t = lock.first_current_transaction()
-            t_desired_lock = t._desired_lock
-            return t_desired_lock[0], t
-
-        for key, lock in self._lock_table.items():
-            try:
-                desired_key, t = get_desired_key_tranc(lock)
-                other_lock = self._lock_table[desired_key]
-                other_desired_key, other_t = get_desired_key_tranc(other_lock)
-                if other_desired_key == key:
-                    return min(t._xid, other_t._xid)
-            except Exception:
-                continue
+        # Locks keep updating the shared graph, so work on a snapshot. The sets
+        # it holds are replaced, never mutated, so a shallow copy suffices.
+        graph = dict(self._waits_for)
+        # The graph has one entry per blocked transaction of this lock table,
+        # and a cycle needs at least two of them.
+        if len(graph) < 2:
+            return None
+        victim = None
+        for scc in _strongly_connected_components(graph):
+            if len(scc) > 1 or scc[0] in graph.get(scc[0], ()):
+                candidate = min(scc)
+                if victim is None or candidate < victim:
+                    victim = candidate
+        return victim
+
+
+def _strongly_connected_components(graph):
+    """
+    Iterative Tarjan's algorithm. Return a list of the strongly connected
+    components of @graph, each one a list of nodes.
+
+    @param graph: dict mapping a node to an iterable of its successors. Successors
+    that are not keys of the dict are treated as nodes without out-edges.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph.get(succ, ()))))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
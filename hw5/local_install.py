@@ -1,31 +1,83 @@
 import sys
 import os
-import urllib
+import shutil
+import subprocess
 import tarfile
 import hashlib
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
 
 def download_spark():
     bytes_written = 0
     spark_url = "http://eecs.berkeley.edu/~jegonzal/cs186_spark.tar.bz2"
-    if not os.path.exists("cs186_spark.tar.bz2"):
+    md5sum = "fa66ead78d3b40e68472f55a63dcdb55"
+    archive = "cs186_spark.tar.bz2"
+    if not os.path.exists(archive):
         print("Downloading Spark")
-        resp = urllib.urlopen(spark_url)
-        output = open('cs186_spark.tar.bz2','wb')
-        block_len = 524288
-        buf = resp.read(block_len)
-        while buf:
-            output.write(buf)
-            bytes_written += len(buf)
-            buf = resp.read(block_len)
-        output.close()
+        # Download under a temporary name so an interrupted or corrupt
+        # download never leaves a file that looks complete.
+        partial = archive + ".part"
+        digest = hashlib.md5()
+        block_len = 1 << 20
+        try:
+            resp = urlopen(spark_url)
+            try:
+                # Hash while writing so the archive is not read back from disk.
+                with open(partial, 'wb', block_len) as output:
+                    for buf in iter(lambda: resp.read(block_len), b''):
+                        output.write(buf)
+                        digest.update(buf)
+                        bytes_written += len(buf)
+            finally:
+                resp.close()
+            if digest.hexdigest() != md5sum:
+                raise IOError('checksum mismatch for %s' % archive)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.rename(partial, archive)
     return bytes_written
         
+def extract_with_parallel_bzip2(archive, extract_dir):
+    """
+    Extract a .tar.bz2 by piping it through lbzip2 or pbzip2, which decode
+    bz2 blocks on all cores. Returns False if neither tool is available or
+    an attempt fails, so the caller can fall back to tarfile's bz2. A failed
+    attempt removes whatever it left in extract_dir.
+    """
+    for tool in ('lbzip2', 'pbzip2'):
+        try:
+            proc = subprocess.Popen([tool, '-dc', archive], stdout=subprocess.PIPE)
+        except OSError:
+            continue
+        extracted = False
+        try:
+            # Streaming mode, since a pipe is not seekable.
+            tfile = tarfile.open(fileobj=proc.stdout, mode='r|')
+            tfile.extractall()
+            tfile.close()
+            extracted = True
+        except (tarfile.TarError, IOError, OSError):
+            pass
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                extracted = False
+        if extracted:
+            return True
+        shutil.rmtree(extract_dir, ignore_errors=True)
+    return False
+
 def unzip_spark():
     if not (os.path.isdir("cs186_spark") and os.path.exists("cs186_spark")):
         print("Extracting Spark")
-        tfile = tarfile.open('cs186_spark.tar.bz2', 'r:bz2')
-        tfile.extractall()
-        tfile.close()
+        if not extract_with_parallel_bzip2('cs186_spark.tar.bz2', 'cs186_spark'):
+            tfile = tarfile.open('cs186_spark.tar.bz2', 'r:bz2')
+            tfile.extractall()
+            tfile.close()
         
 def setup_environment():
     download_spark()